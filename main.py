@@ -1,15 +1,29 @@
 import asyncio
+import atexit
+import hashlib
 import logging
 import os
-import re
+import shutil
+import sqlite3
+import subprocess
+import sys
 import tempfile
-from contextlib import asynccontextmanager
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, closing, contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, replace
 from pathlib import Path
+from urllib.parse import parse_qs, parse_qsl, urlencode, urlsplit, urlunsplit
+from weakref import WeakValueDictionary
 
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ChatAction, ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart
-from aiogram.types import Message, FSInputFile
+from aiogram.types import FSInputFile, InputFile, Message
 from dotenv import load_dotenv
 from yt_dlp import YoutubeDL
 
@@ -21,6 +35,14 @@ logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(messag
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 IG_COOKIES_PATH = os.getenv("IG_COOKIES_PATH", "").strip()
+VAAPI_DEVICE = os.getenv("VAAPI_DEVICE", "/dev/dri/renderD128").strip()
+# CPU lists like "0-1" / "2-5,7": event loop vs. yt-dlp threads + ffmpeg encodes
+APP_CPUS_SPEC = os.getenv("APP_CPUS", "").strip()
+FFMPEG_CPUS_SPEC = os.getenv("FFMPEG_CPUS", "").strip()
+CACHE_DB_PATH = os.getenv("CACHE_DB_PATH", "cache.sqlite3").strip()
+# Self-hosted telegram-bot-api (e.g. http://localhost:8081); files are then sent
+# by file:// path, so it must see the same filesystem (incl. WORK_DIR)
+BOT_API_URL = os.getenv("BOT_API_URL", "").strip()
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN is missing in .env")
 
@@ -29,62 +51,426 @@ MAX_HEIGHT_TARGET = 480          # 360 if you want even smaller
 TELEGRAM_LIMIT_MB = 2000         # hard limit
 SAFE_LIMIT_MB = 1900             # compress when above this
 SEND_AS_VIDEO_THRESHOLD_MB = 50  # send as video if ≤ 50MB else document
+# Sizes are compared in whole bytes; MB floats are only for logs/messages
+MB = 1024 * 1024
+TELEGRAM_LIMIT_BYTES = TELEGRAM_LIMIT_MB * MB
+SAFE_LIMIT_BYTES = SAFE_LIMIT_MB * MB
+SEND_AS_VIDEO_THRESHOLD_BYTES = SEND_AS_VIDEO_THRESHOLD_MB * MB
+STREAM_MAXRATE_KBPS = 2500       # video bitrate cap when piping ffmpeg straight to Telegram
+# Streamed upload timeout: seconds per second of video (encode may run slower
+# than realtime) plus a fixed margin for the upload tail
+STREAM_TIMEOUT_FACTOR = 3
+STREAM_TIMEOUT_MARGIN = 600
+AUDIO_KBPS = 128
+# Hand ffmpeg an already-open output descriptor (/dev/fd/N) instead of a path
+PREOPEN_OUTPUT = os.path.isdir("/dev/fd")
+CHAT_ACTION_INTERVAL = 4         # Telegram drops a chat action after ~5s
+UPLOAD_CHUNK_SIZE = 1 << 20      # 1 MiB reads while uploading (aiogram default is 64 KiB)
 
-# Concurrency
-CONCURRENCY = asyncio.Semaphore(2)
 
-bot = Bot(BOT_TOKEN)
-dp = Dispatcher()
+# =========================
+# CPU affinity (Linux only)
+# =========================
+def parse_cpus(spec: str) -> set[int]:
+    cpus = set()
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        lo, _, hi = part.partition("-")
+        cpus.update(range(int(lo), int(hi or lo) + 1))
+    return cpus
+
+CAN_PIN = hasattr(os, "sched_setaffinity")
+APP_CPUS = parse_cpus(APP_CPUS_SPEC) if CAN_PIN else set()
+FFMPEG_CPUS = parse_cpus(FFMPEG_CPUS_SPEC) if CAN_PIN else set()
+if CAN_PIN:
+    # Fail here rather than in the yt-dlp thread initializer, which breaks the pool for good
+    ALLOWED_CPUS = os.sched_getaffinity(0)
+    for name, cpus in (("APP_CPUS", APP_CPUS), ("FFMPEG_CPUS", FFMPEG_CPUS)):
+        if cpus - ALLOWED_CPUS:
+            raise RuntimeError(
+                f"{name} has CPUs {sorted(cpus - ALLOWED_CPUS)} outside the usable {sorted(ALLOWED_CPUS)}"
+            )
+if APP_CPUS and not FFMPEG_CPUS:
+    # Children inherit the app's mask; give ffmpeg whatever the app doesn't use
+    FFMPEG_CPUS = (ALLOWED_CPUS - APP_CPUS) or ALLOWED_CPUS
+
+# ffmpeg is started through `taskset -c` (preexec_fn isn't safe with yt-dlp threads running)
+TASKSET = shutil.which("taskset") if FFMPEG_CPUS else None
+if FFMPEG_CPUS and not TASKSET:
+    logging.warning("taskset not found, ffmpeg started by the bot runs unpinned")
+
+def _pin_ydl_thread() -> None:
+    # yt-dlp spawns its own ffmpeg (merges, transcoding downloads); children inherit this
+    os.sched_setaffinity(0, FFMPEG_CPUS)
+
+
+# =========================
+# Video encoder (hardware if available)
+# =========================
+HW_ENCODERS = ("h264_nvenc", "h264_qsv", "h264_vaapi")
+# encoder -> (hwaccel, GPU scale filter) to decode, scale and encode without leaving VRAM
+HW_FRAME_PIPELINES = {
+    "h264_nvenc": ("cuda", "scale_cuda"),
+    "h264_qsv": ("qsv", "scale_qsv"),
+    "h264_vaapi": ("vaapi", "scale_vaapi"),
+}
+
+def hw_input_args(encoder: str, gpu_frames: bool = False) -> list[str]:
+    args = ["-vaapi_device", VAAPI_DEVICE] if encoder == "h264_vaapi" else []
+    if gpu_frames:
+        hwaccel, _ = HW_FRAME_PIPELINES[encoder]
+        args = ["-hwaccel", hwaccel, "-hwaccel_output_format", hwaccel, *args]
+    return args
+
+def scale_filter(max_h: int, encoder: str, gpu_frames: bool = False) -> str:
+    if gpu_frames:
+        _, gpu_scale = HW_FRAME_PIPELINES[encoder]
+        return f"{gpu_scale}=w=-2:h={max_h}"
+    # VAAPI encodes from GPU surfaces: scale on CPU, then upload
+    if encoder == "h264_vaapi":
+        return f"scale=-2:{max_h},format=nv12,hwupload"
+    return f"scale=-2:{max_h}"
+
+def quality_args(crf: int, encoder: str, maxrate_kbps: int | None = None) -> list[str]:
+    """
+    Constant-quality video args; `crf` maps onto each encoder's own quality knob.
+    With `maxrate_kbps` the bitrate is also capped, so output size has an upper bound.
+    """
+    cap = [] if maxrate_kbps is None else [
+        "-maxrate", f"{maxrate_kbps}k", "-bufsize", f"{maxrate_kbps * 2}k",
+    ]
+    if encoder == "h264_nvenc":
+        return ["-c:v", "h264_nvenc", "-preset", "p4", "-rc", "vbr", "-cq", str(crf), "-b:v", "0", *cap]
+    # QSV ICQ and VAAPI constant QP ignore -maxrate; capped runs use VBR instead
+    if encoder == "h264_qsv":
+        if cap:
+            return ["-c:v", "h264_qsv", "-b:v", f"{maxrate_kbps * 2 // 3}k", *cap, "-look_ahead", "0"]
+        return ["-c:v", "h264_qsv", "-global_quality", str(crf), "-look_ahead", "0"]
+    if encoder == "h264_vaapi":
+        if cap:
+            return ["-c:v", "h264_vaapi", "-rc_mode", "VBR", "-b:v", f"{maxrate_kbps * 2 // 3}k", *cap]
+        return ["-c:v", "h264_vaapi", "-qp", str(crf)]
+    if encoder == "libx265":
+        # hvc1 tag so Apple/Telegram clients play HEVC in MP4
+        return ["-c:v", "libx265", "-preset", "veryfast", "-crf", str(crf), *cap, "-tag:v", "hvc1"]
+    return ["-c:v", "libx264", "-preset", "veryfast", "-crf", str(crf), *cap]
+
+def _encoder_works(encoder: str) -> bool:
+    # Being listed only means ffmpeg was built with it; a tiny encode proves the device is there
+    cmd = [
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        *hw_input_args(encoder),
+        "-f", "lavfi", "-i", "color=size=320x240:duration=0.1",
+        "-vf", scale_filter(240, encoder), "-c:v", encoder,
+        "-f", "null", "-",
+    ]
+    try:
+        return subprocess.run(cmd, capture_output=True, timeout=20).returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
 
-# URL patterns (incl. Shorts)
-YOUTUBE_RE = re.compile(
-    r"(https?://)?(www\.)?(youtube\.com/(watch\?v=|shorts/)|youtu\.be/)",
-    re.I,
+def ffmpeg_listing(flag: str) -> str:
+    """
+    Output of `ffmpeg -<flag>` (encoders, filters, hwaccels), "" if ffmpeg is unusable.
+    """
+    try:
+        return subprocess.run(
+            ["ffmpeg", "-hide_banner", flag], capture_output=True, text=True, timeout=20
+        ).stdout
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+FFMPEG_ENCODERS = ffmpeg_listing("-encoders")
+
+def detect_video_encoder() -> str:
+    for encoder in HW_ENCODERS:
+        if f" {encoder} " in FFMPEG_ENCODERS and _encoder_works(encoder):
+            return encoder
+    return "libx264"
+
+def detect_gpu_frames(encoder: str) -> bool:
+    """
+    True if ffmpeg has both the hwaccel and the scale filter matching `encoder`.
+    """
+    if encoder not in HW_FRAME_PIPELINES:
+        return False
+    hwaccel, gpu_scale = HW_FRAME_PIPELINES[encoder]
+    return hwaccel in ffmpeg_listing("-hwaccels").split() and f" {gpu_scale} " in ffmpeg_listing("-filters")
+
+VIDEO_ENCODER = detect_video_encoder()
+HW_ENCODING = VIDEO_ENCODER != "libx264"
+GPU_FRAMES = detect_gpu_frames(VIDEO_ENCODER)
+# Large-file shrinking on CPU: x265 needs ~30-50% fewer bits than x264 for the same quality
+SHRINK_ENCODER = "libx265" if not HW_ENCODING and " libx265 " in FFMPEG_ENCODERS else VIDEO_ENCODER
+logging.info(
+    f"Video encoder: {VIDEO_ENCODER}" + (" (GPU decode/scale)" if GPU_FRAMES else "")
+    + f", shrink encoder: {SHRINK_ENCODER}"
+)
+
+def frame_modes() -> tuple[bool, ...]:
+    # GPU decode can reject some sources, so staged encodes retry with CPU scaling
+    return (True, False) if GPU_FRAMES else (False,)
+
+# Concurrency (CPU is no longer the bottleneck with a hardware encoder)
+DOWNLOAD_WORKERS = 4 if HW_ENCODING else 2
+MAX_QUEUED_JOBS = 32
+# (message, url, platform) waiting for a download worker
+JOBS: asyncio.Queue[tuple[Message, str, str]] = asyncio.Queue(maxsize=MAX_QUEUED_JOBS)
+# yt-dlp runs here instead of asyncio's default executor
+YDL_EXECUTOR = ThreadPoolExecutor(
+    max_workers=DOWNLOAD_WORKERS, thread_name_prefix="ydl",
+    initializer=_pin_ydl_thread if FFMPEG_CPUS else None,
 )
-INSTAGRAM_RE = re.compile(r"(https?://)?(www\.)?instagram\.com/(reel|p|tv)/", re.I)
+
+# Worst case a job holds a near-limit source plus its re-encode
+WORK_BYTES_PER_JOB = TELEGRAM_LIMIT_BYTES + SAFE_LIMIT_BYTES
+
+def default_work_root() -> Path:
+    """
+    A private dir for this process: on RAM-backed /dev/shm only when it can
+    hold every worker's worst case (Docker gives it 64 MB by default), in
+    the temp dir otherwise. Removed again at exit.
+    """
+    try:
+        shm_free = shutil.disk_usage("/dev/shm").free
+    except OSError:
+        shm_free = 0
+    base = "/dev/shm" if shm_free >= DOWNLOAD_WORKERS * WORK_BYTES_PER_JOB else tempfile.gettempdir()
+    root = Path(tempfile.mkdtemp(prefix="instasave-", dir=base))
+    atexit.register(shutil.rmtree, root, True)
+    return root
+
+# Reusable per-job working dirs; a fixed root only when WORK_DIR is set
+WORK_DIR = os.getenv("WORK_DIR", "").strip()
+WORK_ROOT = Path(WORK_DIR) if WORK_DIR else default_work_root()
+WORK_POOL: asyncio.Queue[Path] = asyncio.Queue()
+# Strong refs so fire-and-forget tasks aren't garbage collected mid-flight
+BACKGROUND_TASKS: set[asyncio.Task] = set()
+
+if BOT_API_URL:
+    bot = Bot(BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL, is_local=True)))
+else:
+    bot = Bot(BOT_TOKEN)
+dp = Dispatcher()
+
+# Supported hosts and the media paths on them (incl. Shorts)
+HOSTS = {
+    "youtu.be": "YouTube",
+    "youtube.com": "YouTube",
+    "www.youtube.com": "YouTube",
+    "m.youtube.com": "YouTube",
+    "instagram.com": "Instagram",
+    "www.instagram.com": "Instagram",
+}
+MEDIA_PATHS = {
+    "YouTube": ("/shorts/",),  # plus /watch?v=, checked separately
+    "Instagram": ("/reel/", "/p/", "/tv/"),
+}
+
+OUTTMPL = "%(title).200B.%(ext)s"
+# Only these yt-dlp extractors are registered (instead of all ~1800);
+# anything they delegate to is still loaded on demand by yt-dlp
+YDL_EXTRACTORS = ("Youtube", "YoutubeTab", "Instagram", "InstagramStory")
+
+# Query params that don't change the media (share/tracking junk)
+TRACKING_PARAMS = {"si", "feature", "pp", "t", "igsh", "igshid", "fbclid", "gclid"}
+
+
+@dataclass(frozen=True)
+class Downloaded:
+    """
+    A media file in the pipeline; `size` is stat'ed once whenever the file changes.
+    """
+    path: Path
+    size: int  # bytes
+    title: str
+    duration: float | None = None
+    # Stream facts as reported by yt-dlp (None when unknown)
+    height: int | None = None
+    vcodec: str | None = None
+    acodec: str | None = None
 
 
 # =========================
 # Helpers
 # =========================
-def is_supported_url(url: str) -> bool:
-    return bool(YOUTUBE_RE.search(url) or INSTAGRAM_RE.search(url))
+def with_scheme(url: str) -> str:
+    # Users often paste "youtu.be/…"; yt-dlp's registered extractors need the scheme
+    return url if "://" in url else "https://" + url
 
-def platform_name(url: str) -> str:
-    if YOUTUBE_RE.search(url):
-        return "YouTube"
-    if INSTAGRAM_RE.search(url):
-        return "Instagram"
-    return "Unknown"
+def classify(url: str) -> str | None:
+    """
+    Returns "YouTube"/"Instagram" for a supported link, None otherwise.
+    The link must start the (stripped) message.
+    """
+    try:
+        parts = urlsplit(with_scheme(url))
+    except ValueError:
+        return None
+    host = parts.netloc.lower()
+    plat = HOSTS.get(host)
+    if plat is None:
+        return None
+    if host == "youtu.be":
+        return plat if len(parts.path) > 1 else None
+    if parts.path == "/watch":
+        return plat if parse_qs(parts.query).get("v") else None
+    return plat if parts.path.startswith(MEDIA_PATHS[plat]) else None
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+# One lock per chat so fire-and-forget status edits land in the order issued
+_STATUS_LOCKS: WeakValueDictionary[int, asyncio.Lock] = WeakValueDictionary()
+
+async def _edit_status(lock: asyncio.Lock, status_msg: Message, text: str) -> None:
+    async with lock:
+        try:
+            await status_msg.edit_text(text)
+        except Exception:
+            logging.warning("Status update failed", exc_info=True)
+
+def notify(status_msg: Message, text: str) -> None:
+    """
+    Update the status message without waiting for Telegram's round-trip.
+    """
+    chat_id = status_msg.chat.id
+    lock = _STATUS_LOCKS.get(chat_id)
+    if lock is None:
+        lock = _STATUS_LOCKS[chat_id] = asyncio.Lock()
+    spawn(_edit_status(lock, status_msg, text))
+
+def _init_work_pool() -> None:
+    for i in range(DOWNLOAD_WORKERS):
+        work_dir = WORK_ROOT / str(i)
+        shutil.rmtree(work_dir, ignore_errors=True)  # leftovers from a previous run
+        work_dir.mkdir(parents=True, exist_ok=True)
+        WORK_POOL.put_nowait(work_dir)
+
+async def recycle_work_dir(work_dir: Path) -> None:
+    """
+    Empty a used working dir off the event loop, then return it to the pool.
+    """
+    await asyncio.to_thread(shutil.rmtree, work_dir, True)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    WORK_POOL.put_nowait(work_dir)
+
+_init_work_pool()
 
 def human_mb(bytes_: int) -> float:
-    return round(bytes_ / (1024 * 1024), 2)
+    return round(bytes_ / MB, 2)
+
+def _size(path: Path) -> int:
+    return os.stat(path).st_size
+
+# {"action": ChatAction} of the keep_action block the current job runs in. The
+# dict is shared with the ping task, so switching the action reaches it.
+CHAT_ACTION: ContextVar[dict | None] = ContextVar("chat_action", default=None)
 
 @asynccontextmanager
-async def typing(chat_id: int):
+async def keep_action(chat_id: int, action: ChatAction):
+    """
+    Keep a chat action ("recording video…") visible for the whole block by
+    re-sending it every CHAT_ACTION_INTERVAL seconds from one background task.
+    """
+    state = {"action": action}
+
+    async def ping():
+        while True:
+            try:
+                await bot.send_chat_action(chat_id, state["action"])
+            except Exception:
+                logging.warning("send_chat_action failed", exc_info=True)
+            await asyncio.sleep(CHAT_ACTION_INTERVAL)
+
+    token = CHAT_ACTION.set(state)
+    task = asyncio.create_task(ping())
     try:
-        await bot.send_chat_action(chat_id, ChatAction.TYPING)
         yield
     finally:
-        pass
+        task.cancel()
+        CHAT_ACTION.reset(token)
+
+def switch_action(action: ChatAction) -> None:
+    state = CHAT_ACTION.get()
+    if state is not None:
+        state["action"] = action
+
+# =========================
+# file_id cache (URL -> already uploaded Telegram file)
+# =========================
+def normalize_url(url: str) -> str:
+    parts = urlsplit(with_scheme(url))
+    query = [
+        (k, v) for k, v in parse_qsl(parts.query)
+        if k not in TRACKING_PARAMS and not k.startswith("utm_")
+    ]
+    host = parts.netloc.lower().removeprefix("www.")
+    return urlunsplit(("https", host, parts.path.rstrip("/"), urlencode(sorted(query)), ""))
 
-def build_ydl_opts(tmp_dir: Path, from_instagram: bool, max_h: int = MAX_HEIGHT_TARGET) -> dict:
+def _cache_key(url: str) -> str:
+    return hashlib.sha1(normalize_url(url).encode()).hexdigest()
+
+def _init_cache() -> None:
+    with closing(sqlite3.connect(CACHE_DB_PATH)) as conn, conn:
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS media ("
+            " key TEXT PRIMARY KEY, file_id TEXT NOT NULL, kind TEXT NOT NULL, title TEXT)"
+        )
+
+def _cache_get(key: str):
+    with closing(sqlite3.connect(CACHE_DB_PATH)) as conn:
+        return conn.execute(
+            "SELECT file_id, kind, title FROM media WHERE key = ?", (key,)
+        ).fetchone()
+
+def _cache_set(key: str, file_id: str, kind: str, title: str) -> None:
+    with closing(sqlite3.connect(CACHE_DB_PATH)) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO media (key, file_id, kind, title) VALUES (?, ?, ?, ?)",
+            (key, file_id, kind, title),
+        )
+
+async def get_cached(url: str):
+    """
+    Returns (file_id, kind, title) if this URL was already sent, else None.
+    """
+    try:
+        return await asyncio.to_thread(_cache_get, _cache_key(url))
+    except sqlite3.Error:
+        logging.exception("Cache lookup failed")
+        return None
+
+async def set_cached(url: str, file_id: str, kind: str, title: str) -> None:
+    try:
+        await asyncio.to_thread(_cache_set, _cache_key(url), file_id, kind, title)
+    except sqlite3.Error:
+        logging.exception("Cache store failed")
+
+_init_cache()
+
+def build_ydl_opts(from_instagram: bool, max_h: int = MAX_HEIGHT_TARGET, transcode: bool = False) -> dict:
     """
     Flexible format chain:
-     1) Try MP4 video+audio ≤ max_h
-     2) Try single MP4 ≤ max_h
-     3) Try best MP4
-     4) Fallback to best (any)
+     1) Try H.264 + AAC MP4 video+audio ≤ max_h (sendable without re-encoding)
+     2) Try MP4 video+audio ≤ max_h
+     3) Try single MP4 ≤ max_h
+     4) Try best MP4
+     5) Fallback to best (any)
+    With transcode=True the download itself goes through ffmpeg, which scales
+    to max_h and re-encodes while the stream is still arriving.
     """
     fmt_chain = (
-        f"bv*[height<={max_h}][ext=mp4]+ba[ext=m4a]"
+        f"bv*[height<={max_h}][ext=mp4][vcodec^=avc1]+ba[ext=m4a][acodec^=mp4a]"
+        f"/bv*[height<={max_h}][ext=mp4]+ba[ext=m4a]"
         f"/b[height<={max_h}][ext=mp4]"
         f"/best[ext=mp4]"
         f"/best"
     )
 
     opts = {
-        "outtmpl": str(tmp_dir / "%(title).200B.%(ext)s"),
         "format": fmt_chain,
         "merge_output_format": "mp4",
         "noplaylist": True,
@@ -95,31 +481,155 @@ def build_ydl_opts(tmp_dir: Path, from_instagram: bool, max_h: int = MAX_HEIGHT_
     }
     if from_instagram and IG_COOKIES_PATH:
         opts["cookies"] = IG_COOKIES_PATH
+    if transcode:
+        opts["external_downloader"] = {"default": "ffmpeg"}
+        opts["external_downloader_args"] = {
+            "ffmpeg_i1": hw_input_args(VIDEO_ENCODER),
+            "ffmpeg_o": [
+                "-vf", scale_filter(max_h, VIDEO_ENCODER),
+                *quality_args(28, VIDEO_ENCODER),
+                "-c:a", "aac", "-b:a", f"{AUDIO_KBPS}k",
+            ],
+        }
     return opts
 
-async def ffmpeg_compress(src: Path, dst: Path, max_h: int, crf: int) -> None:
+# Idle, pre-initialized YoutubeDL instances per opts signature (from_instagram, max_h, transcode).
+# An instance is handed to one thread at a time, so per-call params are safe to mutate.
+_YDL_POOL: dict[tuple[bool, int, bool], list[YoutubeDL]] = {}
+_YDL_POOL_LOCK = threading.Lock()
+
+@contextmanager
+def pooled_ydl(tmp_dir: Path, from_instagram: bool, max_h: int = MAX_HEIGHT_TARGET, transcode: bool = False):
+    key = (from_instagram, max_h, transcode)
+    with _YDL_POOL_LOCK:
+        idle = _YDL_POOL.setdefault(key, [])
+        ydl = idle.pop() if idle else None
+    if ydl is None:
+        ydl = YoutubeDL(build_ydl_opts(from_instagram, max_h, transcode), auto_init=False)
+        for ie_key in YDL_EXTRACTORS:
+            ydl.get_info_extractor(ie_key)
+    ydl.params["outtmpl"]["default"] = str(tmp_dir / OUTTMPL)
+    try:
+        yield ydl
+    finally:
+        ydl.save_cookies()
+        with _YDL_POOL_LOCK:
+            _YDL_POOL[key].append(ydl)
+
+async def spawn_ffmpeg(
+    cmd: list[str], stdout=asyncio.subprocess.DEVNULL, pass_fds: tuple[int, ...] = ()
+) -> asyncio.subprocess.Process:
     """
-    Re-encode with H.264 (libx264) + AAC, scale to max_h, CRF controls quality/size.
+    Start ffmpeg (cmd ends with the output), under `taskset -c FFMPEG_CPUS` with a matching
+    thread count when configured.
     """
-    cmd = [
+    kwargs = {"pass_fds": pass_fds} if pass_fds else {}
+    if TASKSET:
+        cpu_list = ",".join(map(str, sorted(FFMPEG_CPUS)))
+        cmd = [TASKSET, "-c", cpu_list, *cmd[:-1], "-threads", str(len(FFMPEG_CPUS)), cmd[-1]]
+    return await asyncio.create_subprocess_exec(
+        *cmd, stdout=stdout, stderr=asyncio.subprocess.DEVNULL, **kwargs
+    )
+
+async def run_ffmpeg(cmd: list[str], dst: Path | None = None) -> int:
+    """
+    Run ffmpeg to completion. With `dst`, cmd has no output argument: the file
+    is opened here and ffmpeg writes MP4 to the inherited descriptor (forced
+    with -f, since /dev/fd/N has no extension to pick the muxer from).
+    """
+    if dst is None:
+        proc = await spawn_ffmpeg(cmd)
+    elif not PREOPEN_OUTPUT:
+        proc = await spawn_ffmpeg([*cmd, str(dst)])
+    else:
+        fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            proc = await spawn_ffmpeg([*cmd, "-f", "mp4", f"/dev/fd/{fd}"], pass_fds=(fd,))
+        finally:
+            os.close(fd)
+    return await proc.wait()
+
+def compress_args(
+    src: Path, max_h: int, crf: int, gpu_frames: bool = False, encoder: str = VIDEO_ENCODER,
+    maxrate_kbps: int | None = None,
+) -> list[str]:
+    """
+    ffmpeg command (without output) re-encoding to `encoder` video + AAC at max_h.
+    """
+    return [
         "ffmpeg", "-y",
+        *hw_input_args(encoder, gpu_frames),
         "-i", str(src),
-        "-vf", f"scale=-2:{max_h}",
-        "-c:v", "libx264", "-preset", "veryfast", "-crf", str(crf),
-        "-c:a", "aac", "-b:a", "128k",
-        str(dst),
+        "-vf", scale_filter(max_h, encoder, gpu_frames),
+        *quality_args(crf, encoder, maxrate_kbps),
+        "-c:a", "aac", "-b:a", f"{AUDIO_KBPS}k",
     ]
-    proc = await asyncio.create_subprocess_exec(
-        *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
-    )
-    await proc.wait()
-    if proc.returncode != 0 or not dst.exists():
+
+async def ffmpeg_compress(src: Path, dst: Path, max_h: int, crf: int, encoder: str = VIDEO_ENCODER) -> None:
+    """
+    Re-encode with `encoder` (H.264 by default) + AAC, scale to max_h, CRF controls quality/size.
+    """
+    for gpu_frames in frame_modes() if encoder == VIDEO_ENCODER else (False,):
+        cmd = compress_args(src, max_h, crf, gpu_frames, encoder)
+        if await run_ffmpeg(cmd, dst) == 0 and dst.exists():
+            return
+    raise RuntimeError("ffmpeg compress failed")
+
+def target_video_kbps(duration: float) -> int:
+    """
+    Average video bitrate that makes `duration` seconds land on SAFE_LIMIT_MB.
+    """
+    return max(int(SAFE_LIMIT_MB * 8 * 1024 / duration) - AUDIO_KBPS, 100)
+
+async def ffmpeg_bitrate(src: Path, dst: Path, max_h: int, video_kbps: int) -> None:
+    """
+    Encode at a fixed average bitrate, so the output size is known up front
+    instead of searched for with CRF. SHRINK_ENCODER (x265/x264) runs two
+    passes; hardware encoders do one pass with maxrate capped at the target.
+    """
+    if HW_ENCODING:
+        for gpu_frames in frame_modes():
+            cmd = [
+                "ffmpeg", "-y",
+                *hw_input_args(VIDEO_ENCODER, gpu_frames),
+                "-i", str(src),
+                "-vf", scale_filter(max_h, VIDEO_ENCODER, gpu_frames),
+                "-c:v", VIDEO_ENCODER,
+                "-b:v", f"{video_kbps}k", "-maxrate", f"{video_kbps}k", "-bufsize", f"{video_kbps * 2}k",
+                "-c:a", "aac", "-b:a", f"{AUDIO_KBPS}k",
+            ]
+            if await run_ffmpeg(cmd, dst) == 0 and dst.exists():
+                return
         raise RuntimeError("ffmpeg compress failed")
 
-async def shrink_until_ok(filepath: Path, status_msg: Message) -> Path:
+    common = [
+        "ffmpeg", "-y",
+        "-i", str(src),
+        "-vf", f"scale=-2:{max_h}",
+        "-c:v", SHRINK_ENCODER, "-preset", "veryfast",
+        "-b:v", f"{video_kbps}k",
+        "-maxrate", f"{int(video_kbps * 1.2)}k", "-bufsize", f"{video_kbps * 2}k",
+    ]
+    passlog = str(dst.with_suffix(""))
+
+    def pass_args(n: int) -> list[str]:
+        if SHRINK_ENCODER == "libx265":
+            # libx265 ignores -pass/-passlogfile; it takes them via its own params
+            return ["-x265-params", f"pass={n}:stats={passlog}.x265.log", "-tag:v", "hvc1"]
+        return ["-pass", str(n), "-passlogfile", passlog]
+
+    if await run_ffmpeg([*common, *pass_args(1), "-an", "-f", "null", os.devnull]) != 0:
+        raise RuntimeError("ffmpeg compress failed (pass 1)")
+    cmd = [*common, *pass_args(2), "-c:a", "aac", "-b:a", f"{AUDIO_KBPS}k"]
+    if await run_ffmpeg(cmd, dst) != 0 or not dst.exists():
+        raise RuntimeError("ffmpeg compress failed (pass 2)")
+
+async def shrink_until_ok(download: Downloaded, status_msg: Message) -> Downloaded:
     """
-    If file is near/over limit, try a few shrinking strategies in order.
-    Returns a path that is ≤ TELEGRAM_LIMIT_MB (or the last attempt).
+    If file is near/over limit, re-encode it to fit.
+    With a known duration this is one two-pass encode sized for SAFE_LIMIT_MB;
+    otherwise try a few CRF strategies in order.
+    Returns a file that is ≤ TELEGRAM_LIMIT_MB (or the last attempt).
     """
     attempts = [
         (MAX_HEIGHT_TARGET, 28),
@@ -127,32 +637,140 @@ async def shrink_until_ok(filepath: Path, status_msg: Message) -> Path:
         (360, 28),
         (360, 30),
     ]
-    current = filepath
-    size_mb = human_mb(current.stat().st_size)
-    if size_mb <= SAFE_LIMIT_MB:
+    current = download
+    if current.size <= SAFE_LIMIT_BYTES:
+        return current
+
+    if download.duration:
+        video_kbps = target_video_kbps(download.duration)
+        max_h = MAX_HEIGHT_TARGET if video_kbps >= 500 else 360
+        notify(
+            status_msg,
+            f"📦 Katta video. Siqilmoqda ({max_h}p, {video_kbps} kbps)…\n"
+            f"📦 Large video. Compressing ({max_h}p, {video_kbps} kbps)…"
+        )
+        candidate = current.path.with_suffix(f".{max_h}p.{video_kbps}k.mp4")
+        await ffmpeg_bitrate(current.path, candidate, max_h=max_h, video_kbps=video_kbps)
+        current = replace(current, path=candidate, size=_size(candidate))
+        logging.info(f"Compressed to ~{human_mb(current.size)} MB @ {max_h}p {video_kbps}kbps")
         return current
 
     for max_h, crf in attempts:
-        await status_msg.edit_text(
+        notify(
+            status_msg,
             f"📦 Katta video. Siqilmoqda ({max_h}p, CRF {crf})…\n"
             f"📦 Large video. Compressing ({max_h}p, CRF {crf})…"
         )
-        candidate = current.with_suffix(f".{max_h}p.crf{crf}.mp4")
-        await ffmpeg_compress(current, candidate, max_h=max_h, crf=crf)
-        size_mb = human_mb(candidate.stat().st_size)
-        logging.info(f"Compressed to ~{size_mb} MB @ {max_h}p CRF{crf}")
-        current = candidate
-        if size_mb <= SAFE_LIMIT_MB:
+        candidate = current.path.with_suffix(f".{max_h}p.crf{crf}.mp4")
+        await ffmpeg_compress(current.path, candidate, max_h=max_h, crf=crf, encoder=SHRINK_ENCODER)
+        current = replace(current, path=candidate, size=_size(candidate))
+        logging.info(f"Compressed to ~{human_mb(current.size)} MB @ {max_h}p CRF{crf}")
+        if current.size <= SAFE_LIMIT_BYTES:
             break
 
     return current
 
-async def send_file(message: Message, filepath: Path, title: str):
-    size_mb = human_mb(filepath.stat().st_size)
-    caption = f"<b>{title}</b>" if title else "Video"
-    await bot.send_chat_action(message.chat.id, ChatAction.UPLOAD_VIDEO)
+def _codec_ok(codec: str | None, names: tuple[str, ...]) -> bool:
+    # Unknown or absent ("none") streams don't force a re-encode
+    return codec is None or codec == "none" or codec.lower().startswith(names)
+
+async def ffmpeg_remux(src: Path, dst: Path) -> None:
+    """
+    Copy streams into MP4 with the moov atom up front; no re-encode.
+    """
+    cmd = ["ffmpeg", "-y", "-i", str(src), "-c", "copy", "-movflags", "+faststart"]
+    if await run_ffmpeg(cmd, dst) != 0 or not dst.exists():
+        raise RuntimeError("ffmpeg remux failed")
+
+async def conform(download: Downloaded, status_msg: Message) -> Downloaded:
+    """
+    For files under the size limit: skip work when yt-dlp already delivered
+    ≤max height H.264/AAC MP4, remux when only the container is off,
+    re-encode to MAX_HEIGHT_TARGET otherwise.
+    """
+    fits = (download.height or 0) <= MAX_HEIGHT_TARGET
+    if fits and _codec_ok(download.vcodec, ("avc1", "h264")) and _codec_ok(download.acodec, ("mp4a", "aac")):
+        if download.path.suffix.lower() == ".mp4":
+            return download
+        candidate = download.path.with_suffix(".remux.mp4")
+        await ffmpeg_remux(download.path, candidate)
+    else:
+        notify(
+            status_msg,
+            f"🎞 {MAX_HEIGHT_TARGET}p MP4 ga o‘tkazilmoqda…\n"
+            f"🎞 Converting to {MAX_HEIGHT_TARGET}p MP4…"
+        )
+        candidate = download.path.with_suffix(f".{MAX_HEIGHT_TARGET}p.crf28.mp4")
+        await ffmpeg_compress(download.path, candidate, max_h=MAX_HEIGHT_TARGET, crf=28)
+    logging.info(f"Conformed {download.path.name} -> {candidate.name}")
+    return replace(download, path=candidate, size=_size(candidate))
+
+def stream_estimate_bytes(duration: float | None) -> int | None:
+    """
+    Upper bound of a bitrate-capped re-encode, or None if duration is unknown.
+    """
+    if not duration:
+        return None
+    return int(duration * (STREAM_MAXRATE_KBPS + AUDIO_KBPS) * 1000 / 8)
+
+class FFmpegStreamFile(InputFile):
+    """
+    Uploads ffmpeg's stdout while it is being encoded, no staging file on disk.
+    Fragmented MP4 is used since a pipe can't be seeked back for the moov atom.
+    """
 
-    if size_mb > TELEGRAM_LIMIT_MB:
+    def __init__(self, src: Path, max_h: int, crf: int, filename: str, chunk_size: int = UPLOAD_CHUNK_SIZE):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.cmd = [
+            *compress_args(src, max_h, crf, maxrate_kbps=STREAM_MAXRATE_KBPS),
+            "-f", "mp4", "-movflags", "frag_keyframe+empty_moov",
+            "pipe:1",
+        ]
+
+    async def read(self, bot: Bot):
+        proc = await spawn_ffmpeg(self.cmd, stdout=asyncio.subprocess.PIPE)
+        try:
+            while chunk := await proc.stdout.read(self.chunk_size):
+                yield chunk
+            await proc.wait()
+            if proc.returncode != 0:
+                # Abort the upload rather than sending a truncated file
+                raise RuntimeError("ffmpeg compress failed")
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+
+def make_caption(title: str) -> str:
+    return f"<b>{title}</b>" if title else "Video"
+
+async def send_cached(message: Message, file_id: str, kind: str, title: str) -> None:
+    caption = make_caption(title)
+    if kind == "video":
+        await message.answer_video(file_id, caption=caption, parse_mode=ParseMode.HTML)
+    else:
+        await message.answer_document(file_id, caption=caption, parse_mode=ParseMode.HTML)
+
+async def send_file(message: Message, download: Downloaded, url: str):
+    # A local Bot API server reads the file itself, no multipart upload
+    file = download.path.as_uri() if BOT_API_URL else FSInputFile(str(download.path), chunk_size=UPLOAD_CHUNK_SIZE)
+    await send_media(message, file, download.size, download.title, url)
+
+async def send_stream(message: Message, download: Downloaded, url: str, est_size: int):
+    src = download.path
+    file = FFmpegStreamFile(src, MAX_HEIGHT_TARGET, 28, filename=f"{src.stem}.mp4")
+    # The request lasts as long as the encode, far past aiogram's default 60s
+    timeout = int(download.duration * STREAM_TIMEOUT_FACTOR) + STREAM_TIMEOUT_MARGIN
+    await send_media(message, file, est_size, download.title, url, request_timeout=timeout)
+
+async def send_media(
+    message: Message, file: InputFile | str, size: int, title: str, url: str,
+    request_timeout: int | None = None,
+):
+    caption = make_caption(title)
+    switch_action(ChatAction.UPLOAD_VIDEO)
+
+    if size > TELEGRAM_LIMIT_BYTES:
         await message.answer(
             "❗️Fayl hajmi Telegram limitidan katta (>2GB), yuborib bo‘lmaydi.\n"
             "❗️File exceeds Telegram limit (>2GB)."
@@ -160,11 +778,16 @@ async def send_file(message: Message, filepath: Path, title: str):
         return
 
     try:
-        file = FSInputFile(str(filepath))
-        if size_mb <= SEND_AS_VIDEO_THRESHOLD_MB:
-            await message.answer_video(file, caption=caption, parse_mode=ParseMode.HTML)
+        if size <= SEND_AS_VIDEO_THRESHOLD_BYTES:
+            method = message.answer_video(file, caption=caption, parse_mode=ParseMode.HTML)
+            sent = await bot(method, request_timeout=request_timeout)
+            kind, media = "video", sent.video
         else:
-            await message.answer_document(file, caption=caption, parse_mode=ParseMode.HTML)
+            method = message.answer_document(file, caption=caption, parse_mode=ParseMode.HTML)
+            sent = await bot(method, request_timeout=request_timeout)
+            kind, media = "document", sent.document
+        if media:
+            await set_cached(url, media.file_id, kind, title)
     except Exception as e:
         logging.exception("Sending file failed")
         await message.answer(f"❌ Yuborishda xato: {e!s}\n❌ Sending failed: {e!s}")
@@ -192,64 +815,108 @@ async def on_start(message: Message):
 @dp.message(F.text)
 async def handle_url(message: Message):
     url = (message.text or "").strip()
-    if not is_supported_url(url):
+    plat = classify(url)
+    if not plat:
         await message.answer(
             "Send a valid YouTube/Instagram link.\n\n"
             "YouTube/Instagram havolasini yuboring."
         )
         return
+    url = with_scheme(url)
+
+    cached = await get_cached(url)
+    if cached:
+        file_id, kind, title = cached
+        try:
+            await send_cached(message, file_id, kind, title)
+            return
+        except TelegramBadRequest:
+            # Stale/foreign file_id: fall back to a fresh download
+            logging.warning("Cached file_id rejected, re-downloading")
 
-    async with CONCURRENCY:
-        plat = platform_name(url)
-        status_msg = await message.answer(f"⏳ Downloading from {plat}…\n\n{plat} dan yuklanmoqda…")
+    try:
+        JOBS.put_nowait((message, url, plat))
+    except asyncio.QueueFull:
+        await message.answer(
+            "⏳ Too many links in the queue, try again in a minute.\n\n"
+            "⏳ Navbat to‘la, bir daqiqadan so‘ng qayta urinib ko‘ring."
+        )
 
-        with tempfile.TemporaryDirectory() as td:
-            tmp_dir = Path(td)
-            ydl_opts = build_ydl_opts(tmp_dir, from_instagram=(plat == "Instagram"))
 
-            try:
-                await bot.send_chat_action(message.chat.id, ChatAction.RECORD_VIDEO)
+# =========================
+# Jobs
+# =========================
+async def process_job(message: Message, url: str, plat: str):
+    status_msg = await message.answer(f"⏳ Downloading from {plat}…\n\n{plat} dan yuklanmoqda…")
 
+    tmp_dir = await WORK_POOL.get()
+    try:
+        async with keep_action(message.chat.id, ChatAction.RECORD_VIDEO):
+            try:
                 def _extract():
-                    with YoutubeDL(ydl_opts) as ydl:
-                        info = ydl.extract_info(url, download=True)
+                    from_instagram = plat == "Instagram"
+                    with pooled_ydl(tmp_dir, from_instagram) as ydl:
+                        info = ydl.extract_info(url, download=False)
+                    if not isinstance(info, dict):
+                        raise RuntimeError("Unexpected info type from yt-dlp")
+                    # Only a taller-than-wanted MP4 fallback gets the transcoding download
+                    # (yt-dlp forces -f <ext>, and WebM can't hold H.264/AAC); conform()
+                    # re-encodes anything else after the plain download
+                    transcode = info.get("ext") == "mp4" and (info.get("height") or 0) > MAX_HEIGHT_TARGET
+                    with pooled_ydl(tmp_dir, from_instagram, transcode=transcode) as ydl:
+                        info = ydl.process_ie_result(info, download=True)
                         # Resolve downloaded filepath
-                        path = None
-                        if isinstance(info, dict):
-                            rd = info.get("requested_downloads") or []
-                            if rd and isinstance(rd, list):
-                                fp = rd[0].get("filepath")
-                                if fp:
-                                    path = Path(fp)
-                            if not path:
-                                path = Path(ydl.prepare_filename(info))
-                                if not path.exists():
-                                    path = path.with_suffix(".mp4")
+                        try:
+                            path = Path(info["requested_downloads"][0]["filepath"])
+                        except (KeyError, IndexError, TypeError):
+                            path = Path(ydl.prepare_filename(info))
+                            if not path.exists():
+                                path = path.with_suffix(".mp4")
+                        try:
+                            size = _size(path)
+                        except FileNotFoundError:
+                            raise FileNotFoundError("Downloaded file not found") from None
+                        title = info.get("title", "video")
+                        if transcode:
+                            # ffmpeg rewrote the streams while downloading
+                            streams = (MAX_HEIGHT_TARGET, "h264", "aac")
                         else:
-                            raise RuntimeError("Unexpected info type from yt-dlp")
-                        title = info.get("title") or "video"
-                        return path, title
+                            streams = (info.get("height"), info.get("vcodec"), info.get("acodec"))
+                        return Downloaded(path, size, title, info.get("duration"), *streams)
 
-                filepath, title = await asyncio.to_thread(_extract)
-                if not filepath or not filepath.exists():
-                    raise FileNotFoundError("Downloaded file not found")
+                loop = asyncio.get_running_loop()
+                download = await loop.run_in_executor(YDL_EXECUTOR, _extract)
 
-                size_mb = human_mb(filepath.stat().st_size)
-                logging.info(f"Downloaded ~{size_mb} MB from {plat}")
+                logging.info(f"Downloaded ~{human_mb(download.size)} MB from {plat}")
 
                 # Compress if near/over safe threshold
-                if size_mb > SAFE_LIMIT_MB:
-                    filepath = await shrink_until_ok(filepath, status_msg)
-
-                await status_msg.edit_text(
+                if download.size > SAFE_LIMIT_BYTES:
+                    # Capped bitrate is known to fit: encode straight into the upload
+                    # (a local Bot API server is cheaper fed a finished file by path)
+                    est_size = stream_estimate_bytes(download.duration)
+                    if not BOT_API_URL and est_size is not None and est_size <= SAFE_LIMIT_BYTES:
+                        notify(
+                            status_msg,
+                            f"📦 Katta video. Siqib yuborilmoqda ({MAX_HEIGHT_TARGET}p)…\n"
+                            f"📦 Large video. Compressing & uploading ({MAX_HEIGHT_TARGET}p)…"
+                        )
+                        await send_stream(message, download, url, est_size)
+                        return
+                    download = await shrink_until_ok(download, status_msg)
+                else:
+                    download = await conform(download, status_msg)
+
+                notify(
+                    status_msg,
                     "✅ Downloaded. Uploading to Telegram…\n\n"
                     "✅ Yuklab olindi. Telegram’ga yuborilmoqda…"
                 )
-                await send_file(message, filepath, title)
+                await send_file(message, download, url)
 
             except Exception as e:
                 logging.exception("Download/Process failed")
-                await status_msg.edit_text(
+                notify(
+                    status_msg,
                     "❌ Download/convert failed. Possible reasons:\n"
                     "• Private/age/region restricted content\n"
                     "• Unsupported/removed link\n"
@@ -260,16 +927,40 @@ async def handle_url(message: Message):
                     "• Noto‘g‘ri yoki o‘chirilgan havola\n"
                     "• Tarmoq/ffmpeg muammosi"
                 )
+    finally:
+        spawn(recycle_work_dir(tmp_dir))
+
+
+async def worker():
+    while True:
+        message, url, plat = await JOBS.get()
+        try:
+            await process_job(message, url, plat)
+        except Exception:
+            logging.exception("Job failed")
+        finally:
+            JOBS.task_done()
 
 
 # =========================
 # Entry point
 # =========================
 async def main():
+    if APP_CPUS:
+        # Only this thread and to_thread workers; YDL_EXECUTOR threads re-pin to FFMPEG_CPUS
+        os.sched_setaffinity(0, APP_CPUS)
+        logging.info(f"Pinned app to CPUs {sorted(APP_CPUS)}, ffmpeg to {sorted(FFMPEG_CPUS)}")
+    for _ in range(DOWNLOAD_WORKERS):
+        spawn(worker())
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        if sys.platform != "win32":
+            # libuv event loop: faster sockets/subprocess pipes than asyncio's selector loop
+            import uvloop
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
     except (KeyboardInterrupt, SystemExit):
         print("Bot stopped.")